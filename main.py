@@ -1,16 +1,21 @@
 import os
+import asyncio
+import csv
 import logging
 import sqlite3
-from datetime import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from itertools import islice
+from typing import Iterable, Iterator
 from telegram import Update
 from telegram.ext import (
     Application, CommandHandler, ContextTypes,
-    MessageHandler, filters
+    MessageHandler, SimpleUpdateProcessor, filters
 )
-import openpyxl
-from openpyxl.styles import Font, Alignment
 import tempfile
-import pandas as pd
 from flask import Flask, request
 
 # -----------------------------
@@ -40,87 +45,535 @@ if not WEBHOOK_URL:
 # -----------------------------
 DB_NAME = "transactions.db"
 
+# Statement text is the key of sqlite3's per-connection prepared-statement cache
+SQL_SELECT_LANGUAGE = "SELECT language FROM user_preferences WHERE user_id = ?"
+SQL_ALL_LANGUAGES = "SELECT user_id, language FROM user_preferences LIMIT ?"
+SQL_SET_LANGUAGE = '''INSERT INTO user_preferences (user_id, language) VALUES (?, ?)
+                      ON CONFLICT(user_id) DO UPDATE SET language = excluded.language'''
+SQL_SET_USERNAME = '''INSERT INTO user_preferences (user_id, username) VALUES (?, ?)
+                      ON CONFLICT(user_id) DO UPDATE SET username = excluded.username
+                      WHERE username IS NOT excluded.username'''
+SQL_INSERT_TX = '''INSERT INTO transactions (user_id, date, amount_cents, category, description)
+                   VALUES (?, ?, ?, ?, ?)'''
+SQL_TOTALS = '''SELECT COALESCE(SUM(amount_cents), 0),
+                       COALESCE(SUM(CASE WHEN amount_cents > 0 THEN amount_cents END), 0),
+                       COALESCE(SUM(CASE WHEN amount_cents < 0 THEN amount_cents END), 0),
+                       COUNT(*)
+                FROM transactions WHERE user_id = ?'''
+SQL_TOTALS_SINCE = " AND date >= ?"
+SQL_TOTALS_CATEGORY = " AND category = ?"
+SQL_HISTORY = '''SELECT date, amount_cents, category, description FROM transactions
+                 WHERE user_id = ? ORDER BY date DESC LIMIT 10'''
+SQL_EXPORT = '''SELECT date, amount_cents, category, description FROM transactions
+                WHERE user_id = ? ORDER BY date'''
+
+# One connection for the whole process; autocommit mode, access serialized by db_lock
+_CONN = None
+db_lock = threading.Lock()
+
+# user_id -> language, least recently used first; warmed in init_database()
+LANG_CACHE_SIZE = 10_000
+_LANG_CACHE = OrderedDict()
+_lang_cache_lock = threading.Lock()
+
+def _cache_language(user_id: int, language: str):
+    with _lang_cache_lock:
+        _LANG_CACHE[user_id] = language
+        _LANG_CACHE.move_to_end(user_id)
+        if len(_LANG_CACHE) > LANG_CACHE_SIZE:
+            _LANG_CACHE.popitem(last=False)
+
 def init_database():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    global _CONN
+    _CONN = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None,
+                            cached_statements=200)
+    c = _CONN.cursor()
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA temp_store=MEMORY")
+    c.execute("PRAGMA cache_size=-65536")
+    c.execute("PRAGMA mmap_size=268435456")
+    c.execute('''CREATE TABLE IF NOT EXISTS user_preferences
+                 (user_id INTEGER PRIMARY KEY,
+                  language TEXT DEFAULT 'en',
+                  username TEXT)''')
+    if "username" not in {row[1] for row in c.execute("PRAGMA table_info(user_preferences)")}:
+        c.execute("ALTER TABLE user_preferences ADD COLUMN username TEXT")
     c.execute('''CREATE TABLE IF NOT EXISTS transactions
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER NOT NULL,
-                  username TEXT,
                   date TEXT NOT NULL,
-                  amount REAL NOT NULL,
+                  amount_cents INTEGER NOT NULL,
                   category TEXT NOT NULL,
                   description TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS user_preferences
-                 (user_id INTEGER PRIMARY KEY,
-                  language TEXT DEFAULT 'en')''')
-    conn.commit()
-    conn.close()
+    columns = {row[1] for row in c.execute("PRAGMA table_xinfo(transactions)")}
+    if "amount" in columns:
+        # Databases created before amounts were stored as integer cents
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("ALTER TABLE transactions ADD COLUMN amount_cents INTEGER NOT NULL DEFAULT 0")
+        # Same rounding as new amounts: half-up on the decimal value, not SQLite's ROUND of a float
+        _CONN.create_function("to_cents", 1, _to_cents, deterministic=True)
+        c.execute("UPDATE transactions SET amount_cents = to_cents(amount) WHERE amount IS NOT NULL")
+        c.execute("ALTER TABLE transactions DROP COLUMN amount")
+        c.execute("COMMIT")
+    if "username" in columns:
+        # Username used to be repeated on every transaction row; keep one copy per user
+        c.execute("BEGIN IMMEDIATE")
+        # With MAX(id), SQLite takes the bare username from that same row: the user's latest one
+        c.execute('''INSERT INTO user_preferences (user_id, username)
+                     SELECT user_id, username FROM
+                         (SELECT user_id, username, MAX(id) FROM transactions
+                          WHERE username IS NOT NULL GROUP BY user_id)
+                     WHERE true
+                     ON CONFLICT(user_id) DO UPDATE SET username = excluded.username''')
+        c.execute("ALTER TABLE transactions DROP COLUMN username")
+        c.execute("COMMIT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tx_user_date ON transactions(user_id, date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tx_user_cat_date ON transactions(user_id, category, date)")
+    # Covers the balance aggregate, so /balance reads only the index
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tx_user_amount ON transactions(user_id, amount_cents)")
+    for user_id, language in c.execute(SQL_ALL_LANGUAGES, (LANG_CACHE_SIZE,)):
+        _cache_language(user_id, language)
+    # Planner statistics let it choose between the overlapping per-user indexes; stale ones from a
+    # tiny table make it scan. analysis_limit samples each index, so refreshing on every start is cheap
+    c.execute("PRAGMA analysis_limit=400")
+    c.execute("ANALYZE")
 
-init_database()
+# Before SQLite 3.46, PRAGMA optimize only re-analyzes tables this connection has queried;
+# run it well within a dyno's lifetime (restarted about daily) to track growth between deploys
+OPTIMIZE_INTERVAL = 60 * 60
+
+def optimize_database():
+    with db_lock:
+        c = _CONN.cursor()
+        c.execute("PRAGMA optimize")
+
+async def optimize_periodically():
+    while True:
+        await asyncio.sleep(OPTIMIZE_INTERVAL)
+        try:
+            await asyncio.to_thread(optimize_database)
+        except Exception as e:
+            logger.warning(f"PRAGMA optimize failed: {e}")
 
 # -----------------------------
 # Language support
 # -----------------------------
 LANGUAGES = {
-    "en": {"start": "🤖 Welcome! Use /add, /balance, /history, /export, /report, /clear, /setlang, /categories, /help."},
-    "ru": {"start": "🤖 Добро пожаловать! Используйте /add, /balance, /history, /export, /report, /clear, /setlang, /categories, /help."},
-    "kg": {"start": "🤖 Кош келдиңиз! /add, /balance, /history, /export, /report, /clear, /setlang, /categories, /help."}
+    "en": {
+        "start": "🤖 Welcome! Use /add, /balance, /history, /export, /report, /clear, /setlang, /categories, /help.",
+        "added": "✅ Added {amount:+,.2f} ({category})\n💰 Balance: {balance:,.2f}",
+        "add_usage": "Usage: /add <amount> <category> [description]",
+        "invalid_category": "❌ Unknown category. See /categories.",
+        "categories": "📂 Categories: {categories}",
+        "balance": "💰 Balance: {balance:,.2f}\n📈 Income: {income:,.2f}\n📉 Expenses: {expenses:,.2f}\n🧾 Transactions: {count}",
+        "report": "📈 Report for the last {days} days\n📈 Income: {income:,.2f}\n📉 Expenses: {expenses:,.2f}\n💰 Total: {balance:,.2f}\n🧾 Transactions: {count}",
+        "report_usage": "Usage: /report [days] [category]",
+        "language_set": "✅ Language set to English.",
+        "setlang_usage": "Usage: /setlang en | ru | kg",
+        "no_transactions": "📭 No transactions yet.",
+        "export_caption": "📊 Your transactions",
+        "export_columns": ("Date", "Amount", "Category", "Description", "Balance", "Income", "Expenses"),
+        "history_header": "📋 Recent transactions:",
+        "file_imported": "📂 Imported {count} transactions.",
+        "file_error": "❌ Could not read the file. Expected columns: Date, Amount, Category, Description.",
+        "file_partial": "⚠️ Imported {count} transactions, then the file could not be read further. The rest was not imported.",
+    },
+    "ru": {
+        "start": "🤖 Добро пожаловать! Используйте /add, /balance, /history, /export, /report, /clear, /setlang, /categories, /help.",
+        "added": "✅ Добавлено {amount:+,.2f} ({category})\n💰 Баланс: {balance:,.2f}",
+        "add_usage": "Использование: /add <сумма> <категория> [описание]",
+        "invalid_category": "❌ Неизвестная категория. Смотрите /categories.",
+        "categories": "📂 Категории: {categories}",
+        "balance": "💰 Баланс: {balance:,.2f}\n📈 Доходы: {income:,.2f}\n📉 Расходы: {expenses:,.2f}\n🧾 Транзакций: {count}",
+        "report": "📈 Отчёт за последние {days} дн.\n📈 Доходы: {income:,.2f}\n📉 Расходы: {expenses:,.2f}\n💰 Итого: {balance:,.2f}\n🧾 Транзакций: {count}",
+        "report_usage": "Использование: /report [дни] [категория]",
+        "language_set": "✅ Язык изменён на русский.",
+        "setlang_usage": "Использование: /setlang en | ru | kg",
+        "no_transactions": "📭 Транзакций пока нет.",
+        "export_caption": "📊 Ваши транзакции",
+        "export_columns": ("Дата", "Сумма", "Категория", "Описание", "Баланс", "Доходы", "Расходы"),
+        "history_header": "📋 Последние транзакции:",
+        "file_imported": "📂 Импортировано транзакций: {count}.",
+        "file_error": "❌ Не удалось прочитать файл. Нужные столбцы: Date, Amount, Category, Description.",
+        "file_partial": "⚠️ Импортировано транзакций: {count}, дальше файл прочитать не удалось. Остальное не импортировано.",
+    },
+    "kg": {
+        "start": "🤖 Кош келдиңиз! /add, /balance, /history, /export, /report, /clear, /setlang, /categories, /help.",
+        "added": "✅ Кошулду {amount:+,.2f} ({category})\n💰 Баланс: {balance:,.2f}",
+        "add_usage": "Колдонуу: /add <сумма> <категория> [сүрөттөмө]",
+        "invalid_category": "❌ Белгисиз категория. /categories караңыз.",
+        "categories": "📂 Категориялар: {categories}",
+        "balance": "💰 Баланс: {balance:,.2f}\n📈 Киреше: {income:,.2f}\n📉 Чыгаша: {expenses:,.2f}\n🧾 Транзакциялар: {count}",
+        "report": "📈 Акыркы {days} күндүн отчёту\n📈 Киреше: {income:,.2f}\n📉 Чыгаша: {expenses:,.2f}\n💰 Жалпы: {balance:,.2f}\n🧾 Транзакциялар: {count}",
+        "report_usage": "Колдонуу: /report [күндөр] [категория]",
+        "language_set": "✅ Тил кыргызчага өзгөртүлдү.",
+        "setlang_usage": "Колдонуу: /setlang en | ru | kg",
+        "no_transactions": "📭 Азырынча транзакциялар жок.",
+        "export_caption": "📊 Сиздин транзакциялар",
+        "export_columns": ("Күнү", "Сумма", "Категория", "Сүрөттөмө", "Баланс", "Киреше", "Чыгаша"),
+        "history_header": "📋 Акыркы транзакциялар:",
+        "file_imported": "📂 Импорттолгон транзакциялар: {count}.",
+        "file_error": "❌ Файлды окуу мүмкүн болгон жок. Керектүү мамычалар: Date, Amount, Category, Description.",
+        "file_partial": "⚠️ Импорттолгон транзакциялар: {count}, андан ары файлды окуу мүмкүн болгон жок. Калганы импорттолгон жок.",
+    },
 }
 
+# Flat (lang, key) -> text table: a single hash lookup per string
+_T = {(lang, key): text for lang, texts in LANGUAGES.items() for key, text in texts.items()}
+
+# Bound str.format of every templated string, resolved once instead of per message
+_TPL = {lang_key: text.format for lang_key, text in _T.items() if isinstance(text, str) and "{" in text}
+
+_LANG_KEYS = frozenset(LANGUAGES)
+_CATEGORIES = frozenset({
+    "salary", "food", "transport", "shopping", "entertainment",
+    "health", "bills", "education", "gifts", "other",
+})
+_CATEGORY_NAMES = ", ".join(sorted(_CATEGORIES))
+
+def _cached_language(user_id: int):
+    with _lang_cache_lock:
+        lang = _LANG_CACHE.get(user_id)
+        if lang is not None:
+            _LANG_CACHE.move_to_end(user_id)
+        return lang
+
 def get_user_language(user_id: int) -> str:
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT language FROM user_preferences WHERE user_id = ?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else "en"
+    lang = _cached_language(user_id)
+    if lang is not None:
+        return lang
+    # Cache writes stay under db_lock so the cache follows the order of DB reads and writes
+    with db_lock:
+        c = _CONN.cursor()
+        c.execute(SQL_SELECT_LANGUAGE, (user_id,))
+        result = c.fetchone()
+        lang = result[0] if result else "en"
+        _cache_language(user_id, lang)
+    return lang
 
 def set_user_language(user_id: int, language: str):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO user_preferences (user_id, language) VALUES (?, ?)", (user_id, language))
-    conn.commit()
-    conn.close()
+    with db_lock:
+        c = _CONN.cursor()
+        c.execute(SQL_SET_LANGUAGE, (user_id, language))
+        _cache_language(user_id, language)
+
+# -----------------------------
+# Transactions
+# -----------------------------
+def get_totals(user_id: int, since: str = None, category: str = None):
+    # (balance, income, expenses, count): SQLite sums integer cents in a single pass
+    query = SQL_TOTALS
+    params = [user_id]
+    if since:
+        query += SQL_TOTALS_SINCE
+        params.append(since)
+    if category:
+        query += SQL_TOTALS_CATEGORY
+        params.append(category)
+    with db_lock:
+        c = _CONN.cursor()
+        c.execute(query, params)
+        balance, income, expenses, count = c.fetchone()
+    return balance / 100, income / 100, expenses / 100, count
+
+# Largest accepted |amount|; keeps cents well inside SQLite's 64-bit INTEGER
+MAX_AMOUNT = 1_000_000_000
+CENT = Decimal("0.01")
+
+def _to_cents(amount) -> int:
+    # Half-up on the decimal text, so 12.345 is 1235 whether typed, uploaded or migrated
+    return int(Decimal(str(amount)).quantize(CENT, ROUND_HALF_UP) * 100)
+
+def _parse_amount(value):
+    # Integer cents, or None for anything that is not a finite number within MAX_AMOUNT
+    text = str(value).strip()
+    if "," in text:
+        # A comma is a decimal separator only as "12,5" / "12,50"; "1,234" or "1,234.50" may be
+        # thousands separators, so rather than guess they are rejected
+        whole, _, frac = text.partition(",")
+        if "." in text or not (frac.isdigit() and len(frac) <= 2):
+            return None
+        text = f"{whole}.{frac}"
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        return None
+    if not amount.is_finite() or abs(amount) > MAX_AMOUNT:
+        return None
+    return _to_cents(amount)
+
+def _do_add(user_id: int, username: str, amount_cents: int, category: str, description: str) -> float:
+    with db_lock:
+        c = _CONN.cursor()
+        c.execute(SQL_SET_USERNAME, (user_id, username))
+        c.execute(SQL_INSERT_TX,
+                  (user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), amount_cents,
+                   category, description))
+    return get_totals(user_id)[0]
+
+def _do_history(user_id: int, header: str):
+    parts = [header, ""]
+    with db_lock:
+        c = _CONN.cursor()
+        c.execute(SQL_HISTORY, (user_id,))
+        for date_str, amount_cents, category, description in c:
+            amount = amount_cents / 100
+            # Stored as "YYYY-MM-DD HH:MM:SS", so "MM/DD HH:MM" is plain slicing
+            formatted_date = f"{date_str[5:10].replace('-', '/')} {date_str[11:16]}"
+            emoji = "📈" if amount > 0 else "📉"
+            parts.append(f"{emoji} {amount:+,.2f} | {category} | {description} ({formatted_date})")
+    return "\n".join(parts) if len(parts) > 2 else None
+
+EXPORT_BATCH = 2000
+# Exports stay in memory up to this size and only spill to a temp file beyond it
+EXPORT_SPOOL_SIZE = 32 * 1024 * 1024
+
+def write_export(user_id: int, output, columns: tuple):
+    # Imported on first use: only /export needs it, keeping it out of startup
+    import xlsxwriter
+    # constant_memory flushes each row to disk once the next one starts, so rows must go in order;
+    # user text is written as plain strings, never turned into formulas or hyperlinks
+    wb = xlsxwriter.Workbook(output, {"constant_memory": True, "strings_to_formulas": False,
+                                      "strings_to_urls": False})
+    ws = wb.add_worksheet("Financial Transactions")
+    bold = wb.add_format({"bold": True, "align": "center"})
+    date_format = wb.add_format({"num_format": "yyyy-mm-dd hh:mm:ss"})
+    for col, width in enumerate((20, 12, 15, 30, 12)):
+        ws.set_column(col, col, width)
+
+    ws.write_row(0, 0, columns[:5], bold)
+    row_idx, income_cents, expenses_cents = 1, 0, 0
+    # Own read-only connection: under WAL it reads beside the shared one without taking db_lock,
+    # and the single SELECT sees one snapshot, so the totals below match the rows
+    conn = sqlite3.connect(f"file:{DB_NAME}?mode=ro", uri=True)
+    try:
+        c = conn.cursor()
+        c.arraysize = EXPORT_BATCH
+        c.execute(SQL_EXPORT, (user_id,))
+        while rows := c.fetchmany():
+            for date_str, amount_cents, category, description in rows:
+                if amount_cents > 0:
+                    income_cents += amount_cents
+                else:
+                    expenses_cents += amount_cents
+                balance_cents = income_cents + expenses_cents
+                ws.write_datetime(row_idx, 0, datetime.fromisoformat(date_str), date_format)
+                ws.write_row(row_idx, 1, (amount_cents / 100, category, description, balance_cents / 100))
+                row_idx += 1
+    finally:
+        conn.close()
+
+    row_idx += 1
+    for label, value in ((columns[5], income_cents / 100), (columns[6], expenses_cents / 100),
+                         (columns[4], (income_cents + expenses_cents) / 100)):
+        ws.write(row_idx, 0, label, bold)
+        ws.write_number(row_idx, 1, value)
+        row_idx += 1
+    wb.close()
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        return datetime.fromisoformat(str(value).strip()).strftime("%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+
+def _cell(row: tuple, i):
+    return row[i] if i is not None and i < len(row) else None
+
+def _table_rows(user_id: int, table: Iterator[tuple]) -> Iterator[tuple]:
+    # First row is the header; rows whose date or amount does not parse (NaN, inf and
+    # out-of-range amounts included) are skipped
+    header = [str(h).strip() if h is not None else "" for h in next(table, ())]
+    date_i, amount_i = header.index("Date"), header.index("Amount")
+    cat_i = header.index("Category") if "Category" in header else None
+    desc_i = header.index("Description") if "Description" in header else None
+    for row in table:
+        date, amount_cents = _parse_date(_cell(row, date_i)), _parse_amount(_cell(row, amount_i))
+        if date is None or amount_cents is None:
+            continue
+        # Unknown categories are filed under "other", keeping their name as the fallback description
+        name = str(_cell(row, cat_i) or "other").strip().lower()
+        category = name if name in _CATEGORIES else "other"
+        description = str(_cell(row, desc_i) or name)
+        yield user_id, date, amount_cents, category, description
+
+def _csv_rows(user_id: int, path: str) -> Iterator[tuple]:
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        yield from _table_rows(user_id, csv.reader(f))
+
+def _xlsx_rows(user_id: int, path: str) -> Iterator[tuple]:
+    import openpyxl  # only needed for .xlsx uploads
+    # Read-only mode streams rows from the sheet XML without building the workbook in memory
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from _table_rows(user_id, wb.active.iter_rows(values_only=True))
+    finally:
+        wb.close()
+
+BULK_BATCH = 10_000
+
+class PartialImport(Exception):
+    # Raised when an upload fails after some chunks were already committed
+    def __init__(self, count: int):
+        super().__init__(f"failed after {count} rows")
+        self.count = count
+
+def insert_transactions(rows: Iterable[tuple]) -> int:
+    # One transaction per BULK_BATCH rows: a journal sync per chunk rather than per row,
+    # without holding the whole upload in memory or the lock for the whole parse
+    count = 0
+    rows = iter(rows)
+    try:
+        while chunk := list(islice(rows, BULK_BATCH)):
+            with db_lock:
+                c = _CONN.cursor()
+                c.execute("BEGIN IMMEDIATE")
+                try:
+                    c.executemany(SQL_INSERT_TX, chunk)
+                except Exception:
+                    c.execute("ROLLBACK")
+                    raise
+                c.execute("COMMIT")
+            count += len(chunk)
+    except Exception as e:
+        if count:
+            raise PartialImport(count) from e
+        raise
+    return count
+
+def _do_import(user_id: int, username: str, path: str, suffix: str) -> int:
+    rows = _csv_rows if suffix == ".csv" else _xlsx_rows
+    with db_lock:
+        c = _CONN.cursor()
+        c.execute(SQL_SET_USERNAME, (user_id, username))
+    return insert_transactions(rows(user_id, path))
 
 # -----------------------------
 # Telegram Handlers
 # -----------------------------
+async def user_language(user_id: int) -> str:
+    # Cache hits are answered on the event loop; a miss waits for db_lock and SQLite in a worker
+    lang = _cached_language(user_id)
+    return lang if lang is not None else await asyncio.to_thread(get_user_language, user_id)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    lang = get_user_language(user_id)
-    await update.message.reply_text(LANGUAGES[lang]["start"])
+    lang = await user_language(update.effective_user.id)
+    await update.message.reply_text(_T[lang, "start"])
 
-# Пример для add, balance и других команд оставим пустым, но структуру можно добавить
 async def add_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("✅ /add работает! (добавь логику)")
+    user = update.effective_user
+    lang = await user_language(user.id)
+    amount_cents = _parse_amount(context.args[0]) if context.args else None
+    if amount_cents is None or len(context.args) < 2:
+        await update.message.reply_text(_T[lang, "add_usage"])
+        return
+    category = context.args[1].lower()
+    if category not in _CATEGORIES:
+        await update.message.reply_text(_T[lang, "invalid_category"])
+        return
+    description = " ".join(context.args[2:]) or category
+
+    balance = await asyncio.to_thread(_do_add, user.id, user.username, amount_cents, category, description)
+    await update.message.reply_text(_TPL[lang, "added"](
+        amount=amount_cents / 100, category=category, balance=balance))
 
 async def show_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("💰 /balance работает! (добавь логику)")
+    user_id = update.effective_user.id
+    lang = await user_language(user_id)
+    balance, income, expenses, count = await asyncio.to_thread(get_totals, user_id)
+    await update.message.reply_text(_TPL[lang, "balance"](
+        balance=balance, income=income, expenses=expenses, count=count))
 
 async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("📋 /history работает! (добавь логику)")
+    user_id = update.effective_user.id
+    lang = await user_language(user_id)
+    history_message = await asyncio.to_thread(_do_history, user_id, _T[lang, "history_header"])
+    await update.message.reply_text(history_message or _T[lang, "no_transactions"])
 
 async def export_transactions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("📊 /export работает! (добавь логику)")
+    user_id = update.effective_user.id
+    lang = await user_language(user_id)
+    if not (await asyncio.to_thread(get_totals, user_id))[3]:
+        await update.message.reply_text(_T[lang, "no_transactions"])
+        return
+
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as buf:
+        await asyncio.to_thread(write_export, user_id, buf, _T[lang, "export_columns"])
+        buf.seek(0)
+        filename = f"transactions_{datetime.now().strftime('%Y%m%d')}.xlsx"
+        # PTB reads file objects whole anyway, and an in-memory spool has no .name for it to inspect
+        await update.message.reply_document(document=buf.read(), filename=filename,
+                                            caption=_T[lang, "export_caption"])
+
+MAX_REPORT_DAYS = 36_500
 
 async def generate_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("📈 /report работает! (добавь логику)")
+    user_id = update.effective_user.id
+    lang = await user_language(user_id)
+    try:
+        days = int(context.args[0]) if context.args else 30
+        if not 1 <= days <= MAX_REPORT_DAYS:
+            raise ValueError(days)
+        since = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    except (ValueError, OverflowError):
+        await update.message.reply_text(_T[lang, "report_usage"])
+        return
+    category = context.args[1].lower() if len(context.args) > 1 else None
+
+    balance, income, expenses, count = await asyncio.to_thread(get_totals, user_id, since, category)
+    report = _TPL[lang, "report"](
+        days=days, balance=balance, income=income, expenses=expenses, count=count)
+    if category:
+        report = f"📂 {category}\n{report}"
+    await update.message.reply_text(report)
 
+# Пример для clear и help оставим пустым, но структуру можно добавить
 async def clear_transactions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🗑️ /clear работает! (добавь логику)")
 
 async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("🌐 /setlang работает! (добавь логику)")
+    user_id = update.effective_user.id
+    if not context.args or context.args[0] not in _LANG_KEYS:
+        await update.message.reply_text(_T[await user_language(user_id), "setlang_usage"])
+        return
+    lang = context.args[0]
+    await asyncio.to_thread(set_user_language, user_id, lang)
+    await update.message.reply_text(_T[lang, "language_set"])
 
 async def show_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("📂 /categories работает! (добавь логику)")
+    lang = await user_language(update.effective_user.id)
+    await update.message.reply_text(_TPL[lang, "categories"](categories=_CATEGORY_NAMES))
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❓ /help работает! (добавь логику)")
 
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("📂 Файл обработан! (добавь логику)")
+    user = update.effective_user
+    lang = await user_language(user.id)
+    document = update.message.document
+    suffix = os.path.splitext(document.file_name or "")[1].lower()
+
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp_file:
+        path = tmp_file.name
+    try:
+        tg_file = await document.get_file()
+        await tg_file.download_to_drive(path)
+        count = await asyncio.to_thread(_do_import, user.id, user.username, path, suffix)
+    except PartialImport as e:
+        logger.warning(f"Import of {document.file_name} for user {user.id} stopped: {e.__cause__}")
+        await update.message.reply_text(_TPL[lang, "file_partial"](count=e.count))
+        return
+    except Exception as e:
+        logger.warning(f"Failed to import {document.file_name} for user {user.id}: {e}")
+        await update.message.reply_text(_T[lang, "file_error"])
+        return
+    finally:
+        os.unlink(path)
+
+    await update.message.reply_text(_TPL[lang, "file_imported"](count=count))
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.warning(f'Update {update} caused error {context.error}')
@@ -128,8 +581,46 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------------
 # Flask + Webhook
 # -----------------------------
+# Updates accepted by webhook() whose handlers have not finished yet; beyond this Telegram gets 503.
+# Every handler is blocking (the default): a block=False handler would return its permit as soon
+# as it was scheduled. Slow ones (/export, uploads) still run alongside others via concurrent_updates
+MAX_PENDING_UPDATES = 2000
+_pending_updates = threading.BoundedSemaphore(MAX_PENDING_UPDATES)
+
+class PendingUpdateProcessor(SimpleUpdateProcessor):
+    # The update fetcher drains the queue into tasks at once, so the cap is released here instead
+    async def do_process_update(self, update, coroutine):
+        try:
+            await coroutine
+        finally:
+            _pending_updates.release()
+
 app = Flask(__name__)
-application = Application.builder().token(TELEGRAM_TOKEN).build()
+# No Updater (updates arrive via Flask); webhook() admits at most MAX_PENDING_UPDATES at a time
+application = (
+    Application.builder()
+    .token(TELEGRAM_TOKEN)
+    .updater(None)
+    .concurrent_updates(PendingUpdateProcessor(256))
+    # One HTTP connection per concurrently processed update; wait for a free one rather than fail
+    .connection_pool_size(256)
+    .pool_timeout(30)
+    .build()
+)
+
+# The Application runs on its own event loop in a background thread; Flask hands updates to it
+LOOP = asyncio.new_event_loop()
+# Pool behind asyncio.to_thread; SQLite work is serialized by db_lock, so a few workers suffice
+LOOP.set_default_executor(ThreadPoolExecutor(max_workers=8, thread_name_prefix="worker"))
+
+UPLOAD_EXTENSIONS = frozenset({"xlsx", "csv"})
+
+class UploadFilter(filters.MessageFilter):
+    # One set lookup per document instead of OR-ing a FileExtension filter per extension
+    def filter(self, message) -> bool:
+        name = message.document.file_name if message.document else None
+        # Same suffix rule as handle_file, so a file named just "csv" has no extension
+        return bool(name) and os.path.splitext(name)[1].lower().lstrip(".") in UPLOAD_EXTENSIONS
 
 # Register handlers
 application.add_handler(CommandHandler("start", start))
@@ -142,16 +633,24 @@ application.add_handler(CommandHandler("clear", clear_transactions))
 application.add_handler(CommandHandler("setlang", set_language))
 application.add_handler(CommandHandler("categories", show_categories))
 application.add_handler(CommandHandler("help", help_command))
-application.add_handler(MessageHandler(
-    filters.Document.FileExtension("xlsx") | filters.Document.FileExtension("xls") | filters.Document.FileExtension("csv"),
-    handle_file
-))
+application.add_handler(MessageHandler(UploadFilter(), handle_file))
 application.add_error_handler(error_handler)
 
+async def enqueue_update(update: Update):
+    application.update_queue.put_nowait(update)
+
 @app.route(f"/{TELEGRAM_TOKEN}", methods=["POST"])
 def webhook():
     update = Update.de_json(request.get_json(force=True), application.bot)
-    application.update_queue.put(update)
+    if not _pending_updates.acquire(blocking=False):
+        # Telegram retries non-2xx deliveries, so this defers the update instead of losing it
+        return "Busy", 503
+    try:
+        asyncio.run_coroutine_threadsafe(enqueue_update(update), LOOP).result(timeout=1.0)
+    except FutureTimeout:
+        # The enqueue is still scheduled and will run once the loop catches up; a non-2xx
+        # here would have Telegram redeliver and the update processed twice
+        logger.warning(f"Update {update.update_id} enqueue is slow; accepted anyway")
     return "OK"
 
 @app.route("/")
@@ -161,8 +660,19 @@ def home():
 # -----------------------------
 # Main
 # -----------------------------
+_optimize_task = None
+
+async def start_bot():
+    global _optimize_task
+    await application.initialize()
+    await application.start()
+    _optimize_task = asyncio.create_task(optimize_periodically())
+    # Every handler works on messages; don't have Telegram POST any other update type
+    await application.bot.set_webhook(WEBHOOK_URL, allowed_updates=[Update.MESSAGE])
+
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(application.bot.set_webhook(WEBHOOK_URL))
+    init_database()
+    threading.Thread(target=LOOP.run_forever, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(start_bot(), LOOP).result()
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
 